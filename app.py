@@ -1,26 +1,44 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.font_manager as fm
+import matplotlib.dates as mdates
+from matplotlib.figure import Figure
+from matplotlib.collections import LineCollection
+from matplotlib.lines import Line2D
 import requests
+import orjson
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
+import time
+import io
+
+try:
+    from tsdownsample import MinMaxLTTBDownsampler
+except ImportError:  # tsdownsample 미설치 시 다운샘플링 없이 원본 데이터를 그림
+    MinMaxLTTBDownsampler = None
 
 # --- 1. 앱 기본 설정 및 폰트 설정 ---
 st.set_page_config(layout="wide")
 
 # [수정] 프로젝트에 포함된 폰트 파일을 직접 사용하는 방식으로 변경
+# 폰트를 matplotlib에 한 번만 등록하고 전역 기본값으로 지정 (그래프마다 fontproperties 지정 불필요)
 @st.cache_resource
-def get_font_prop():
+def register_font():
     font_path = os.path.join('fonts', 'NanumGothic.ttf')
     if os.path.exists(font_path):
-        return fm.FontProperties(fname=font_path)
+        fm.fontManager.addfont(font_path)
+        return fm.FontProperties(fname=font_path).get_name()
     # 폰트 파일이 없을 경우, Streamlit 기본 폰트를 사용하도록 시도
     # (이 경우 한글이 깨질 수 있음)
     return None
 
-font_prop = get_font_prop()
-if font_prop:
-    plt.rcParams['font.family'] = font_prop.get_name()
+font_name = register_font()
+if font_name:
+    plt.rcParams['font.family'] = font_name
+    plt.rcParams['font.sans-serif'] = [font_name]
 else:
     st.warning("'fonts/NanumGothic.ttf' 폰트 파일을 찾을 수 없습니다. 한글이 깨질 수 있습니다.")
 plt.rcParams['axes.unicode_minus'] = False
@@ -29,91 +47,214 @@ plt.rcParams['axes.unicode_minus'] = False
 # API 서버 주소
 API_BASE_URL = "https://lighthorse.duckdns.org"
 
+# 그래프를 PNG로 저장할 때의 해상도 (다운샘플링 기준 픽셀 수 계산에도 사용)
+PNG_DPI = 110
+
 
 # --- 2. API 통신 및 데이터 처리 함수 ---
 
-@st.cache_data(ttl=3600) 
-def fetch_stock_list_from_api():
+@st.cache_resource
+def get_session():
+    """API 서버와의 연결을 재사용하기 위한 공용 requests 세션을 생성합니다."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=Retry(total=2, backoff_factor=0.3))
+    session.mount('https://', adapter)
+    return session
+
+def cache_bucket(seconds):
+    """캐시 키로 넘길 시간 구간 번호를 반환합니다. (같은 구간의 데이터와 그래프 캐시가 같은 응답을 보도록 함)"""
+    return int(time.time() // seconds)
+
+@st.cache_resource
+def get_stock_list_validator():
+    """종목 목록 재검증(ETag/Last-Modified)에 쓸 마지막 응답 정보를 보관합니다."""
+    return {}
+
+@st.cache_data(ttl=3600, max_entries=1)
+def fetch_stock_list_from_api(bucket):
     """API 서버로부터 분석 가능한 전체 주식 목록을 가져옵니다."""
     api_url = f"{API_BASE_URL}/os/stocks"
+    last = get_stock_list_validator()
+    headers = {}
+    if last.get('etag'):
+        headers['If-None-Match'] = last['etag']
+    if last.get('last_modified'):
+        headers['If-Modified-Since'] = last['last_modified']
     try:
-        response = requests.get(api_url, timeout=10)
+        response = get_session().get(api_url, headers=headers, timeout=10)
+        # 목록이 바뀌지 않았으면 서버는 본문 없이 304만 응답함
+        if response.status_code == 304 and 'payload' in last:
+            return last['payload']
         response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
+        payload = orjson.loads(response.content)
+        last.clear()
+        last.update(
+            etag=response.headers.get('ETag'),
+            last_modified=response.headers.get('Last-Modified'),
+            payload=payload,
+        )
+        return payload
+    except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
         st.error(f"전체 종목 목록 API 호출 실패: {e}")
         return []
 
-@st.cache_data(ttl=600) 
-def fetch_data_from_api(stock_code):
+@st.cache_data(ttl=600, max_entries=256)
+def fetch_data_from_api(stock_code, bucket):
     """API 서버로부터 특정 종목의 상세 시계열 데이터를 가져옵니다."""
     api_url = f"{API_BASE_URL}/os/stock/{stock_code}"
     try:
-        response = requests.get(api_url, timeout=10)
+        response = get_session().get(api_url, timeout=10)
         response.raise_for_status()
-        df = pd.DataFrame(response.json())
-        df['날짜'] = pd.to_datetime(df['날짜'])
+        rows = orjson.loads(response.content)
+        df = pd.DataFrame.from_records(rows)
+        # 형식을 지정해 dateutil 범용 파서 대신 ISO 고속 경로를 사용
+        df['날짜'] = pd.to_datetime(df['날짜'], format='ISO8601', cache=True)
         df.set_index('날짜', inplace=True)
         return df
-    except requests.exceptions.RequestException as e:
+    except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
         st.error(f"종목 데이터 API 호출 실패 ({stock_code}): {e}")
         return None
 
+@st.cache_data(max_entries=1)
+def get_name_code_maps(bucket):
+    """종목명 목록과 {종목명: 종목코드} 사전을 한 번만 만들어 캐시합니다."""
+    stock_list = fetch_stock_list_from_api(bucket)
+    names = [s['name'] for s in stock_list]
+    # 같은 이름의 종목이 여러 개면 기존 순차 검색과 같이 처음 나온 종목을 사용
+    name_to_code = {}
+    for s in stock_list:
+        name_to_code.setdefault(s['name'], s['code'])
+    return names, name_to_code
+
 def calculate_stats(data, osc_col_name):
     """지정된 오실레이터 컬럼으로 통계치를 계산합니다."""
     if data.empty or osc_col_name not in data.columns: return {}
+    arr = data[osc_col_name].dropna().to_numpy(dtype=np.float64)
+    if arr.size == 0: return {}
+    # 분위수 4개를 한 번의 np.quantile 호출로 계산 (정렬/분할 1회)
+    q10, q25, q75, q90 = np.quantile(arr, [0.1, 0.25, 0.75, 0.9])
     stats = {
-        '현재 값': data[osc_col_name].iloc[-1],
-        '상위 10%': data[osc_col_name].quantile(0.9),
-        '상위 25%': data[osc_col_name].quantile(0.75),
-        '평균': data[osc_col_name].mean(),
-        '하위 25%': data[osc_col_name].quantile(0.25),
-        '하위 10%': data[osc_col_name].quantile(0.1),
+        '현재 값': arr[-1],
+        '상위 10%': q90,
+        '상위 25%': q75,
+        '평균': arr.mean(),
+        '하위 25%': q25,
+        '하위 10%': q10,
     }
     return stats
 
-# [수정] 그래프 함수에 font_prop 인자 추가하여 폰트 적용
-def create_macd_graph(data, stats, stock_code, stock_name, osc_col_name, title_prefix, font_prop):
+def downsample_series(series, n_out=800, max_pts=None):
+    """그래프 폭에 맞춰 시계열을 MinMaxLTTB 방식으로 다운샘플링합니다."""
+    if MinMaxLTTBDownsampler is None:
+        # tsdownsample이 없으면 픽셀 수의 2배를 넘는 부분만 일정 간격으로 솎아냄
+        if max_pts and len(series) > max_pts:
+            series = series.iloc[::-(-len(series) // max_pts)]  # 올림 나눗셈이어야 max_pts 이하로 줄어듦
+        return series.index, series.to_numpy()
+    if len(series) <= n_out:
+        return series.index, series.to_numpy()
+    # NaN은 MinMaxLTTB 입력을 만들 때만 제외 (그대로 그리는 경우에는 결측 구간이 끊겨 보이도록 유지)
+    series = series.dropna()
+    x = series.index.values.astype('int64')
+    y = series.to_numpy()
+    idx = MinMaxLTTBDownsampler().downsample(x, y, n_out=n_out)
+    return series.index[idx], y[idx]
+
+def set_fixed_ylim(ax, values, include_zero=False):
+    """값의 최소/최대로 y축 범위를 미리 고정하여 matplotlib의 자동 스케일 재계산을 건너뜁니다."""
+    if len(values) == 0: return
+    lo, hi = float(values.min()), float(values.max())
+    if include_zero:
+        lo, hi = min(lo, 0.0), max(hi, 0.0)
+    pad = (hi - lo) * 0.05 or abs(hi) * 0.05 or 1.0
+    ax.set_ylim(lo - pad, hi + pad)  # set_ylim은 해당 축의 y 자동 스케일을 끔
+
+def create_macd_graph(data, stats, stock_code, stock_name, osc_col_name, title_prefix):
     """지정된 오실레이터 컬럼으로 그래프(figure 객체)를 생성합니다."""
-    fig, ax1 = plt.subplots(figsize=(12, 8)) # 모바일 가독성을 위해 크기 약간 조정
+    # pyplot 전역 figure 관리자에 등록되지 않는 Figure를 직접 만들어 plt.close 없이도 메모리가 회수되도록 함
+    fig = Figure(figsize=(12, 8)) # 모바일 가독성을 위해 크기 약간 조정
+    ax1 = fig.subplots()
+    max_pts = int(fig.get_figwidth() * PNG_DPI * 2)
     
-    ax1.plot(data.index, data['시가총액'], label='시가총액', color='black')
-    ax1.set_ylabel('시가총액', fontproperties=font_prop)
+    x_cap, y_cap = downsample_series(data['시가총액'], max_pts=max_pts)
+    cap_line, = ax1.plot(x_cap, y_cap, label='시가총액', color='black')
+    set_fixed_ylim(ax1, data['시가총액'].dropna().to_numpy())
+    ax1.set_ylabel('시가총액')
     ax1.tick_params(axis='y', labelcolor='black')
-    for date in data.index:
-        ax1.axvline(date, color='gray', linestyle=':', linewidth=0.5)
+    # 날짜마다 axvline을 긋는 대신 주요 날짜 눈금에만 그리드를 표시
+    # 로케이터를 바꾸면 포매터도 같은 로케이터를 보도록 함께 지정해야 눈금 라벨 형식이 유지됨
+    date_locator = mdates.AutoDateLocator()
+    ax1.xaxis.set_major_locator(date_locator)
+    ax1.xaxis.set_major_formatter(mdates.AutoDateFormatter(date_locator))
+    ax1.grid(True, which='major', axis='x', color='gray', linestyle=':', linewidth=0.5)
 
     ax2 = ax1.twinx()
-    ax2.plot(data.index, data[osc_col_name], label=osc_col_name, color='red')
-    ax2.set_ylabel('MACD 오실레이터', fontproperties=font_prop)
+    x_osc, y_osc = downsample_series(data[osc_col_name], max_pts=max_pts)
+    osc_line, = ax2.plot(x_osc, y_osc, label=osc_col_name, color='red')
+    # 0 기준선이 항상 보이도록 0을 포함한 범위로 고정
+    set_fixed_ylim(ax2, data[osc_col_name].dropna().to_numpy(), include_zero=True)
+    ax2.set_ylabel('MACD 오실레이터')
     ax2.tick_params(axis='y', labelcolor='black')
     
     ax2.axhline(0, color='gray', linestyle='--', linewidth=0.7)
     
+    handles = [cap_line, osc_line]
     if stats:
+        # 통계 기준선들을 axhline 여러 개 대신 LineCollection 하나로 그림
+        segments, colors, linestyles, linewidths = [], [], [], []
         for key, value in stats.items():
             if key == '현재 값': continue
             linestyle = '-' if key == '평균' else '--'
             color = 'purple' if key == '평균' else ('green' if '10%' in key else 'blue')
             linewidth = 1.5 if key == '평균' else 1
-            ax2.axhline(value, color=color, linestyle=linestyle, linewidth=linewidth, label=key)
+            segments.append([(0, value), (1, value)])
+            colors.append(color)
+            linestyles.append(linestyle)
+            linewidths.append(linewidth)
+            handles.append(Line2D([0], [0], color=color, linestyle=linestyle, linewidth=linewidth, label=key))
+        # x는 축 좌표(0~1), y는 데이터 좌표로 그려 axhline과 동일하게 가로 전체를 덮음
+        lc = LineCollection(segments, colors=colors, linestyles=linestyles, linewidths=linewidths,
+                            transform=ax2.get_yaxis_transform())
+        ax2.add_collection(lc, autolim=False)
 
-    plt.title(f"[{title_prefix}] {stock_name}({stock_code})", fontproperties=font_prop, fontsize=16)
-    fig.legend(loc='upper left', prop=font_prop)
-    plt.tight_layout()
+    ax2.set_title(f"[{title_prefix}] {stock_name}({stock_code})", fontsize=16)
+    fig.legend(handles=handles, loc='upper left')
+    fig.tight_layout()
     
     return fig
 
+def stats_to_markdown(stats):
+    """통계치 dict를 마크다운 표 문자열로 변환합니다. (6행짜리 표에 DataFrame을 만들지 않음)"""
+    return "| 항목 | 값 |\n|---|---:|\n" + "\n".join(f"| {k} | {format(v, ',.5f')} |" for k, v in stats.items())
+
+@st.cache_data(ttl=600, max_entries=32, show_spinner=False)
+def render_macd_png(stock_code, stock_name, osc_col_name, title_prefix, bucket):
+    """그래프를 PNG 바이트로 렌더링하여 캐시합니다. (재실행 시 matplotlib 렌더링 생략)"""
+    # 통계표와 같은 bucket의 데이터를 써야 표와 그래프가 서로 다른 시점을 보여주지 않음
+    data = fetch_data_from_api(stock_code, bucket)
+    if data is None or data.empty or osc_col_name not in data.columns: return None
+    stats = calculate_stats(data, osc_col_name)
+    fig = create_macd_graph(data, stats, stock_code, stock_name, osc_col_name, title_prefix)
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', dpi=PNG_DPI, bbox_inches='tight')
+    return buf.getvalue()
+
+def render_tab(data, stock_code, stock_name, osc_col_name, title_prefix, bucket):
+    """탭 하나의 통계표와 그래프를 그립니다."""
+    if osc_col_name not in data.columns: return
+    st.markdown(stats_to_markdown(calculate_stats(data, osc_col_name)))
+    png = render_macd_png(stock_code, stock_name, osc_col_name, title_prefix, bucket)
+    if png is not None:
+        st.image(png, width="stretch")
+
 
 # --- 3. Streamlit 앱 화면 구성 ---
 
 st.title("📈 MACD 계산 방식 비교 분석기")
 
-stock_list = fetch_stock_list_from_api()
+stock_names, name_to_code = get_name_code_maps(cache_bucket(3600))
 
-if stock_list:
+if stock_names:
     # [수정] 검색 UI를 텍스트 입력 대신 Selectbox로 변경
-    stock_names = [s['name'] for s in stock_list]
     selected_name = st.selectbox(
         '종목을 검색하거나 선택하세요:',
         options=stock_names,
@@ -124,34 +265,29 @@ if stock_list:
     # 종목이 선택되었을 경우 결과 표시
     if selected_name:
         # 선택된 이름으로 종목 코드 찾기
-        target_code = next((s['code'] for s in stock_list if s['name'] == selected_name), None)
+        target_code = name_to_code.get(selected_name)
         
         if target_code:
-            data = fetch_data_from_api(target_code)
+            data_bucket = cache_bucket(600)
+            data = fetch_data_from_api(target_code, data_bucket)
 
             if data is not None and not data.empty:
                 
+                osc_specs = [
+                    ('MACD_Oscillator_Accurate', '정확한 계산'),
+                    ('MACD_Oscillator_Inaccurate', '부정확한 계산'),
+                ]
+
                 # [수정] 결과를 탭으로 분리하여 모바일 최적화
-                tab1, tab2 = st.tabs(["✅ 정확한 계산 (1년 데이터)", "⚠️ 부정확한 계산 (77일 데이터)"])
+                # on_change="rerun"으로 탭 상태를 추적하여 현재 열린 탭의 내용만 실행
+                tab1, tab2 = st.tabs(["✅ 정확한 계산 (1년 데이터)", "⚠️ 부정확한 계산 (77일 데이터)"], on_change="rerun")
 
                 with tab1:
-                    if 'MACD_Oscillator_Accurate' in data.columns:
-                        stats_acc = calculate_stats(data, 'MACD_Oscillator_Accurate')
-                        stats_df_acc = pd.DataFrame(list(stats_acc.items()), columns=['항목', '값'])
-                        stats_df_acc['값'] = stats_df_acc['값'].apply(lambda x: f"{x:,.5f}")
-                        st.table(stats_df_acc)
-                        
-                        fig_acc = create_macd_graph(data, stats_acc, target_code, selected_name, 'MACD_Oscillator_Accurate', '정확한 계산', font_prop)
-                        st.pyplot(fig_acc)
+                    if tab1.open:
+                        render_tab(data, target_code, selected_name, *osc_specs[0], data_bucket)
 
                 with tab2:
-                    if 'MACD_Oscillator_Inaccurate' in data.columns:
-                        stats_inacc = calculate_stats(data, 'MACD_Oscillator_Inaccurate')
-                        stats_df_inacc = pd.DataFrame(list(stats_inacc.items()), columns=['항목', '값'])
-                        stats_df_inacc['값'] = stats_df_inacc['값'].apply(lambda x: f"{x:,.5f}")
-                        st.table(stats_df_inacc)
-
-                        fig_inacc = create_macd_graph(data, stats_inacc, target_code, selected_name, 'MACD_Oscillator_Inaccurate', '부정확한 계산', font_prop)
-                        st.pyplot(fig_inacc)
+                    if tab2.open:
+                        render_tab(data, target_code, selected_name, *osc_specs[1], data_bucket)
 else:
     st.error("API 서버에 연결할 수 없습니다. 서버가 실행 중인지 확인하고 페이지를 새로고침 하세요.")